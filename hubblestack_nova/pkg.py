@@ -63,15 +63,108 @@ from __future__ import absolute_import
 import logging
 
 import fnmatch
+import multiprocessing
+import operator
+import re
 import yaml
 import os
-import copy
 import salt.utils
 
+from collections import defaultdict
 from distutils.version import LooseVersion
+from functools import lru_cache
+
+try:
+    # Use the libyaml C loader when available; it's an order of magnitude
+    # faster than the pure-Python loader on large profiles
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    # packaging parses and compares faster than the deprecated LooseVersion
+    from packaging.version import Version, InvalidVersion
+    HAS_PACKAGING = True
+except ImportError:
+    HAS_PACKAGING = False
 
 log = logging.getLogger(__name__)
 
+# Version range modifiers are inclusive: '<' means <=, '>' means >=
+_CMP = {'<': operator.le,
+        '>': operator.ge}
+
+# Template for the per-tag dicts built in _get_tags; copying a presized
+# dict is cheaper than growing a fresh literal for every tag
+_BASE_FORMATTED = {'name': None,
+                   'tag': None,
+                   'module': 'pkg',
+                   'type': None}
+
+
+@lru_cache(maxsize=1024)
+def _lv(version):
+    '''
+    Parse a version string, caching the result since the same versions recur
+    across distros and duplicate tags. PEP 440 strings parse to packaging's
+    Version; rpm/dpkg-style strings that don't conform fall back to
+    LooseVersion.
+    '''
+    if HAS_PACKAGING:
+        try:
+            return Version(version)
+        except InvalidVersion:
+            pass
+    return LooseVersion(version)
+
+
+def _vcmp(oper, installed, target):
+    '''
+    Compare two version strings with ``oper`` (an operator module function).
+    A Version does not order against a LooseVersion, so when only one side
+    is PEP 440 compare both sides as LooseVersion instead.
+    '''
+    try:
+        return oper(_lv(installed), _lv(target))
+    except (TypeError, AttributeError):
+        return oper(LooseVersion(installed), LooseVersion(target))
+
+
+def _load(stream):
+    '''
+    Load a YAML stream with the fastest available safe loader.
+
+    Callers constructing the ``data_list`` passed to ``audit()`` should use
+    this instead of ``yaml.safe_load()`` so that the libyaml C loader is
+    picked up when installed.
+    '''
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+# Below this many documents a process pool costs more than it saves
+_PARALLEL_THRESHOLD = 16
+
+
+def _load_all(documents):
+    '''
+    Load many YAML documents, spreading them over a process pool when there
+    are enough to be worth the fork overhead.
+
+    YAML parsing is CPU-bound and the GIL serializes it in-process, so
+    callers building the ``data_list`` for ``audit()`` from a large profile
+    set can use this for near-linear scaling. Documents must be strings
+    (not open file handles) so they can be shipped to the workers.
+    '''
+    documents = list(documents)
+    if len(documents) > _PARALLEL_THRESHOLD:
+        pool = multiprocessing.Pool()
+        try:
+            return pool.map(_load, documents)
+        finally:
+            pool.close()
+            pool.join()
+    return [_load(document) for document in documents]
+
 
 def __virtual__():
     if salt.utils.is_windows():
@@ -79,10 +172,26 @@ def __virtual__():
     return True
 
 
-def audit(data_list, tags, verbose=False, show_profile=False, debug=False):
+# Schedulers call audit() repeatedly over the same loaded YAML objects, so
+# keep a small cache of merged tag indexes; bounded so reloaded configs
+# don't accumulate stale entries
+_tags_cache = {}
+_TAGS_CACHE_SIZE = 16
+
+
+def _build_tags(data_list, show_profile):
     '''
-    Run the pkg audits contained in the YAML files processed by __virtual__
+    Merge the yaml data in data_list and build the tag index for this
+    distro, caching the result keyed on the identity of the data objects
     '''
+    cache_key = (tuple(id(data) for profile, data in data_list),
+                 bool(show_profile),
+                 __grains__.get('osfinger'))
+    cached = _tags_cache.get(cache_key)
+    if cached is not None:
+        _, __data__, __tags__ = cached
+        return __data__, __tags__
+
     __data__ = {}
     for profile, data in data_list:
         if show_profile:
@@ -91,128 +200,120 @@ def audit(data_list, tags, verbose=False, show_profile=False, debug=False):
             _merge_yaml(__data__, data)
     __tags__ = _get_tags(__data__)
 
+    if len(_tags_cache) >= _TAGS_CACHE_SIZE:
+        # Evict the oldest entry (dicts preserve insertion order)
+        del _tags_cache[next(iter(_tags_cache))]
+    # Keep a reference to the keyed data dicts alongside the result so
+    # their ids can't be recycled for new objects while the entry is live;
+    # eviction releases the pins and the result together
+    _tags_cache[cache_key] = (tuple(data for profile, data in data_list),
+                              __data__, __tags__)
+    return __data__, __tags__
+
+
+def audit(data_list, tags, verbose=False, show_profile=False, debug=False):
+    '''
+    Run the pkg audits contained in the YAML files processed by __virtual__
+    '''
+    __data__, __tags__ = _build_tags(data_list, show_profile)
+
     if debug:
         log.debug('pkg audit __data__:')
         log.debug(__data__)
         log.debug('pkg audit __tags__:')
         log.debug(__tags__)
 
-    ret = {'Success': [], 'Failure': [], 'Controlled': []}
-    for tag in __tags__:
-        if fnmatch.fnmatch(tag, tags):
-            for tag_data in __tags__[tag]:
-                if 'control' in tag_data:
-                    ret['Controlled'].append(tag_data)
-                    continue
-                name = tag_data['name']
-                audittype = tag_data['type']
-
-                # Blacklisted packages (must not be installed)
-                if audittype == 'blacklist':
-                    if __salt__['pkg.version'](name):
-                        ret['Failure'].append(tag_data)
-                    else:
-                        ret['Success'].append(tag_data)
-
-                # Whitelisted packages (must be installed)
-                elif audittype == 'whitelist':
-                    if 'version' in tag_data:
-                        mod, _, version = tag_data['version'].partition('=')
-                        if not version:
-                            version = mod
-                            mod = ''
-
-                        if mod == '<':
-                            if (LooseVersion(__salt__['pkg.version'](name)) <=
-                                    LooseVersion(version)):
-                                ret['Success'].append(tag_data)
-                            else:
-                                ret['Failure'].append(tag_data)
-
-                        elif mod == '>':
-                            if (LooseVersion(__salt__['pkg.version'](name)) >=
-                                    LooseVersion(version)):
-                                ret['Success'].append(tag_data)
-                            else:
-                                ret['Failure'].append(tag_data)
-
-                        elif not mod:
-                            # Just peg to the version, no > or <
-                            if __salt__['pkg.version'](name) == version:
-                                ret['Success'].append(tag_data)
-                            else:
-                                ret['Failure'].append(tag_data)
-
-                        else:
-                            # Invalid modifier
-                            log.error('Invalid modifier in version {0} for pkg {1} audit {2}'
-                                      .format(tag_data['version'], name, tag))
-                            tag_data = copy.deepcopy(tag_data)
-                            # Include an error in the failure
-                            tag_data['error'] = 'Invalid modifier {0}'.format(mod)
-                            ret['Failure'].append(tag_data)
-
-                    else:  # No version checking
-                        if __salt__['pkg.version'](name):
-                            ret['Success'].append(tag_data)
-                        else:
-                            ret['Failure'].append(tag_data)
-
-    failure = []
-    success = []
-    controlled = []
+    # Fetch installed packages once rather than dispatching pkg.version for
+    # every tag; pkg.version returns '' for missing packages, matching the
+    # dict.get() default here
+    pkgs = __salt__['pkg.list_pkgs']()
 
-    if not verbose:
-        # Pull out just the tag and description
-        tags_descriptions = set()
-
-        for tag_data in ret['Failure']:
-            tag = tag_data['tag']
-            description = tag_data.get('description')
-            if (tag, description) not in tags_descriptions:
-                failure.append({tag: description})
-                tags_descriptions.add((tag, description))
-
-        tags_descriptions = set()
-
-        for tag_data in ret['Success']:
-            tag = tag_data['tag']
-            description = tag_data.get('description')
-            if (tag, description) not in tags_descriptions:
-                success.append({tag: description})
-                tags_descriptions.add((tag, description))
-
-        control_reasons = set()
-
-        for tag_data in ret['Controlled']:
-            tag = tag_data['tag']
-            control_reason = tag_data.get('control', '')
-            description = tag_data.get('description')
-            if (tag, description, control_reason) not in control_reasons:
-                tag_dict = {'description': description,
-                        'control': control_reason}
-                controlled.append({tag: tag_dict})
-                control_reasons.add((tag, description, control_reason))
+    def _ver(name):
+        return pkgs.get(name, '')
 
+    # A tag filter without glob metacharacters is an exact match, so answer
+    # it with a single dict lookup instead of fnmatching every tag
+    if not any(char in tags for char in '*?['):
+        matched = {tags: __tags__[tags]} if tags in __tags__ else {}
     else:
-        # Format verbose output as single-key dictionaries with tag as key
-        for tag_data in ret['Failure']:
-            tag = tag_data['tag']
-            failure.append({tag: tag_data})
-
-        for tag_data in ret['Success']:
-            tag = tag_data['tag']
-            success.append({tag: tag_data})
+        # Compile the tag glob once instead of re-translating it for every tag
+        _tag_match = re.compile(fnmatch.translate(tags)).match
+        matched = {tag: __tags__[tag] for tag in __tags__ if _tag_match(tag)}
 
-        for tag_data in ret['Controlled']:
-            tag = tag_data['tag']
-            controlled.append({tag: tag_data})
-
-    ret['Controlled'] = controlled
-    ret['Success'] = success
-    ret['Failure'] = failure
+    ret = {'Success': [], 'Failure': [], 'Controlled': []}
+    if not verbose:
+        # Deduplicate inline as results are classified, rather than building
+        # full tag_data lists and re-walking them afterwards
+        seen = {'Success': {}, 'Failure': {}, 'Controlled': {}}
+
+    def _record(category, tag_data):
+        if verbose:
+            # Verbose output is single-key dictionaries with tag as key;
+            # drop the underscore-prefixed fields _get_tags precomputed so
+            # they don't leak into the report
+            ret[category].append({tag_data['tag']:
+                                  {key: value for key, value in tag_data.items()
+                                   if not key.startswith('_')}})
+        elif category == 'Controlled':
+            key = (tag_data['tag'], tag_data.get('control', ''))
+            seen['Controlled'].setdefault(key, tag_data.get('description'))
+        else:
+            seen[category].setdefault(tag_data['tag'], tag_data.get('description'))
+
+    for tag, tag_list in matched.items():
+        for tag_data in tag_list:
+            if 'control' in tag_data:
+                _record('Controlled', tag_data)
+                continue
+            name = tag_data['name']
+            audittype = tag_data['type']
+
+            # Blacklisted packages (must not be installed)
+            if audittype == 'blacklist':
+                _record('Failure' if _ver(name) else 'Success', tag_data)
+
+            # Whitelisted packages (must be installed)
+            elif audittype == 'whitelist':
+                if 'version' in tag_data:
+                    # Modifier and version were parsed by _get_tags
+                    mod = tag_data['_mod']
+                    version = tag_data['_version']
+                    installed = _ver(name)
+
+                    if mod in _CMP:
+                        passed = _vcmp(_CMP[mod], installed, version)
+                    elif not mod:
+                        # Just peg to the version, no > or <
+                        passed = installed == version
+                    else:
+                        # Invalid modifier, already logged by _get_tags.
+                        # Shallow copy so the error doesn't pollute the
+                        # shared tag data
+                        tag_data = dict(tag_data)
+                        # Include an error in the failure
+                        tag_data['error'] = 'Invalid modifier {0}'.format(mod)
+                        passed = False
+                    _record('Success' if passed else 'Failure', tag_data)
+
+                else:  # No version checking
+                    _record('Success' if _ver(name) else 'Failure', tag_data)
 
-    if not ret['Controlled']:
+    if not verbose:
+        # Materialize the deduplicated tag/description pairs collected above
+        ret['Failure'] = [{tag: description}
+                          for tag, description in seen['Failure'].items()]
+        ret['Success'] = [{tag: description}
+                          for tag, description in seen['Success'].items()]
+        # Most audits have no controls at all; skip building (and then
+        # popping) an empty Controlled list
+        if seen['Controlled']:
+            ret['Controlled'] = [{tag: {'description': description,
+                                        'control': control_reason}}
+                                 for (tag, control_reason), description
+                                 in seen['Controlled'].items()]
+        else:
+            del ret['Controlled']
+    elif not ret['Controlled']:
         ret.pop('Controlled')
 
     return ret
@@ -222,16 +323,16 @@ def _merge_yaml(ret, data, profile=None):
     '''
     Merge two yaml dicts together at the pkg:blacklist and pkg:whitelist level
     '''
-    if 'pkg' not in ret:
-        ret['pkg'] = {}
+    pkg = ret.setdefault('pkg', {})
     for topkey in ('blacklist', 'whitelist'):
         if topkey in data.get('pkg', {}):
-            if topkey not in ret['pkg']:
-                ret['pkg'][topkey] = []
-            for key, val in data['pkg'][topkey].iteritems():
-                if profile and isinstance(val, dict):
-                    val['nova_profile'] = profile
-                ret['pkg'][topkey].append({key: val})
+            toplist = pkg.setdefault(topkey, [])
+            if profile:
+                for val in data['pkg'][topkey].values():
+                    if isinstance(val, dict):
+                        val['nova_profile'] = profile
+            toplist.extend({key: val}
+                           for key, val in data['pkg'][topkey].items())
     return ret
 
 
@@ -239,26 +340,38 @@ def _get_tags(data):
     '''
     Retrieve all the tags for this distro from the yaml
     '''
-    ret = {}
+    ret = defaultdict(list)
     distro = __grains__.get('osfinger')
-    for toplist, toplevel in data.get('pkg', {}).iteritems():
+    # The same osfinger keys appear across many audit_ids, so remember
+    # whether each one matched this distro instead of re-globbing
+    osfinger_matches = {}
+
+    def _match_distro(osfinger):
+        match = osfinger_matches.get(osfinger)
+        if match is None:
+            match = any(fnmatch.fnmatch(distro, finger.strip())
+                        for finger in osfinger.split(','))
+            osfinger_matches[osfinger] = match
+        return match
+
+    for toplist, toplevel in data.get('pkg', {}).items():
         # pkg:blacklist
         for audit_dict in toplevel:
             # pkg:blacklist:0
-            for audit_id, audit_data in audit_dict.iteritems():
+            for audit_id, audit_data in audit_dict.items():
                 # pkg:blacklist:0:telnet
                 tags_dict = audit_data.get('data', {})
                 # pkg:blacklist:0:telnet:data
+                # Strip the 'data' key once per audit_id instead of popping
+                # it from every formatted_data dict below
+                base = {key: value for key, value in audit_data.items()
+                        if key != 'data'}
                 tags = None
                 for osfinger in tags_dict:
                     if osfinger == '*':
                         continue
-                    osfinger_list = [finger.strip() for finger in osfinger.split(',')]
-                    for osfinger_glob in osfinger_list:
-                        if fnmatch.fnmatch(distro, osfinger_glob):
-                            tags = tags_dict.get(osfinger)
-                            break
-                    if tags is not None:
+                    if _match_distro(osfinger):
+                        tags = tags_dict.get(osfinger)
                         break
                 # If we didn't find a match, check for a '*'
                 if tags is None:
@@ -267,24 +380,34 @@ def _get_tags(data):
                 if isinstance(tags, dict):
                     # malformed yaml, convert to list of dicts
                     tmp = []
-                    for name, tag in tags.iteritems():
+                    for name, tag in tags.items():
                         tmp.append({name: tag})
                     tags = tmp
                 for item in tags:
-                    for name, tag in item.iteritems():
+                    for name, tag in item.items():
                         tag_data = {}
-                        # Whitelist could have a dictionary, not a string
+                        # Whitelist could have a dictionary, not a string;
+                        # its values are scalars, so a shallow copy is enough
                         if isinstance(tag, dict):
-                            tag_data = copy.deepcopy(tag)
+                            tag_data = dict(tag)
                             tag = tag_data.pop('tag')
-                        if tag not in ret:
-                            ret[tag] = []
-                        formatted_data = {'name': name,
-                                          'tag': tag,
-                                          'module': 'pkg',
-                                          'type': toplist}
+                        formatted_data = _BASE_FORMATTED.copy()
+                        formatted_data['name'] = name
+                        formatted_data['tag'] = tag
+                        formatted_data['type'] = toplist
                         formatted_data.update(tag_data)
-                        formatted_data.update(audit_data)
-                        formatted_data.pop('data')
+                        formatted_data.update(base)
+                        if 'version' in formatted_data:
+                            # Parse the version modifier once at load time so
+                            # audit() doesn't re-partition it on every run
+                            mod, _, version = formatted_data['version'].partition('=')
+                            if not version:
+                                version = mod
+                                mod = ''
+                            if mod not in ('', '<', '>'):
+                                log.error('Invalid modifier in version {0} for pkg {1} audit {2}'
+                                          .format(formatted_data['version'], name, tag))
+                            formatted_data['_mod'] = mod
+                            formatted_data['_version'] = version
                         ret[tag].append(formatted_data)
-    return ret
+    return dict(ret)